@@ -0,0 +1,34 @@
+"""
+One-shot migration: convert challenge options stored as JSON strings into
+native BSON arrays.
+
+Run from the backend directory:
+    python -m scripts.migrate_options
+"""
+import json
+import asyncio
+
+from src.database.models import db_manager
+
+
+async def migrate_options() -> int:
+    """Rewrite every string-encoded options field as a list, returning the count"""
+    db_manager.connect()
+    challenges = db_manager.challenges
+    migrated = 0
+    async for doc in challenges.find({"options": {"$type": "string"}}, {"options": 1}):
+        try:
+            options = json.loads(doc["options"])
+        except json.JSONDecodeError:
+            print(f"Skipping challenge {doc['_id']}: options are not valid JSON")
+            continue
+
+        await challenges.update_one({"_id": doc["_id"]}, {"$set": {"options": options}})
+        migrated += 1
+
+    await db_manager.close()
+    return migrated
+
+
+if __name__ == "__main__":
+    print(f"Migrated options on {asyncio.run(migrate_options())} challenge(s)")
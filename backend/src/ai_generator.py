@@ -1,24 +1,43 @@
 import os
-import json
-import re
-import uuid
-from typing import Dict, Any
+import logging
+import time
+import asyncio
+import hashlib
+import itertools
+from collections import deque
+from contextlib import aclosing
+from typing import Dict, Any, AsyncIterable, AsyncIterator, Deque, Optional, Set, Tuple
+import httpx
+import orjson
+import fastjsonschema
 from dotenv import load_dotenv
-from huggingface_hub import InferenceClient
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 HF_TOKEN = os.getenv("HF_API_KEY")
+MODEL = os.getenv("HF_MODEL", "HuggingFaceTB/SmolLM3-3B")
+# OpenAI-compatible chat endpoint of the HF inference router
+HF_CHAT_URL = os.getenv("HF_CHAT_URL", "https://router.huggingface.co/v1/chat/completions")
+HF_POOL_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20)
 
-# Initialize HF Inference Client
-client = InferenceClient(
-    provider="hf-inference",
-    api_key=HF_TOKEN,
-)
+# Difficulties served from the challenge pool; anything else goes straight to the model
+DIFFICULTIES = ("easy", "medium", "hard")
+POOL_SIZE = 20
+POOL_REFILL_THRESHOLD = 5
+POOL_TTL_SECONDS = 6 * 60 * 60
+# Cap on pool-fill completions in flight at once, so prewarm doesn't burst the provider
+MAX_CONCURRENT_FILLS = 4
 
+# Bounded retries with exponential backoff for timeouts and dropped connections
+# (httpx raises both as TransportError subclasses)
+MAX_RETRIES = 3
+RETRY_BACKOFF_SECONDS = 0.5
+RETRY_BACKOFF_MAX_SECONDS = 4
+RETRYABLE_ERRORS = (httpx.TransportError,)
 
-def generate_challenge_with_ai(difficulty: str) -> Dict[str, Any]:
-    system_prompt = """You are an expert coding challenge creator. 
+SYSTEM_PROMPT = """You are an expert coding challenge creator. 
 
 Your task is to generate a coding question with multiple choice answers.
 The question should be appropriate for the specified difficulty level.
@@ -39,52 +58,268 @@ Return the challenge in the following JSON structure:
 Do not include explanations, markdown, or extra text outside the JSON object.
 """
 
-    rand_tag = str(uuid.uuid4())
-    user_request = f"Generate a {difficulty} difficulty coding challenge. ID: {rand_tag}"
-
-    try:
-        # Call Hugging Face API
-        response = client.chat.completions.create(
-            model="HuggingFaceTB/SmolLM3-3B",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_request},
-            ],
-            temperature=0.7,
-            max_tokens=800,
+_SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+_USER_PROMPT_TEMPLATE = "Generate a {difficulty} difficulty coding challenge. Variant: {variant}"
+# Bounded set of prompt variants so pool fills differ without per-call entropy
+_VARIANTS = itertools.cycle(range(POOL_SIZE))
+# The ":hf-inference" suffix pins the router to the hf-inference provider
+_COMPLETION_PARAMS = {"model": f"{MODEL}:hf-inference", "temperature": 0.7, "max_tokens": 400}
+
+# Compiled once; raises fastjsonschema.JsonSchemaException on invalid model output
+_validate_challenge = fastjsonschema.compile({
+    "type": "object",
+    "required": ["title", "options", "correct_answer_id", "explanation"],
+    "properties": {
+        "title": {"type": "string"},
+        "options": {"type": "array", "minItems": 4, "maxItems": 4, "items": {"type": "string"}},
+        "correct_answer_id": {"type": "integer", "minimum": 0, "maximum": 3},
+        "explanation": {"type": "string"},
+    },
+})
+
+# One pooled HTTP client for every completion, so keep-alive connections (and
+# their TLS sessions) are reused instead of handshaking per call
+client = httpx.AsyncClient(
+    headers={"Authorization": f"Bearer {HF_TOKEN}"},
+    timeout=20,
+    limits=HF_POOL_LIMITS,
+)
+
+
+async def _stream_deltas(response: httpx.Response) -> AsyncIterator[str]:
+    """Yield the content deltas of a streamed chat completion (server-sent events)"""
+    async for line in response.aiter_lines():
+        if not line.startswith("data:"):
+            continue
+        data = line[5:].strip()
+        if data == "[DONE]":
+            return
+
+        choices = orjson.loads(data).get("choices")
+        if choices:
+            yield choices[0].get("delta", {}).get("content") or ""
+
+
+async def _read_json_object(deltas: AsyncIterable[str]) -> str:
+    """
+    Accumulate streamed completion deltas until the first top-level JSON object
+    closes, then stop reading so trailing tokens are never downloaded.
+    Returns exactly the object's text; raises ValueError if no object completes.
+    """
+    parts = []
+    consumed = 0  # characters in the tokens before the current one
+    start = 0
+    depth = 0
+    in_string = False
+    escaped = False
+    async for token in deltas:
+        parts.append(token)
+
+        for i, ch in enumerate(token):
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif ch == "\\":
+                    escaped = True
+                elif ch == '"':
+                    in_string = False
+            elif ch == '"' and depth:
+                in_string = True
+            elif ch == "{":
+                if not depth:
+                    start = consumed + i
+                depth += 1
+            elif ch == "}" and depth:
+                depth -= 1
+                if depth == 0:
+                    return "".join(parts)[start:consumed + i + 1]
+
+        consumed += len(token)
+
+    raise ValueError("No valid JSON found in model response")
+
+
+async def _request_challenge(difficulty: str) -> Dict[str, Any]:
+    """Ask the model for a single challenge, raising if the response is unusable"""
+    prompt = _USER_PROMPT_TEMPLATE.format(difficulty=difficulty, variant=next(_VARIANTS))
+    payload = {
+        "messages": [_SYSTEM_MESSAGE, {"role": "user", "content": prompt}],
+        "stream": True,
+        **_COMPLETION_PARAMS,
+    }
+
+    # Call Hugging Face API, retrying transient failures
+    for attempt in range(1, MAX_RETRIES + 1):
+        try:
+            # Leaving the stream context closes the response, so stopping early
+            # hands the connection back to the pool
+            async with client.stream("POST", HF_CHAT_URL, json=payload) as response:
+                response.raise_for_status()
+                async with aclosing(_stream_deltas(response)) as deltas:
+                    object_text = await _read_json_object(deltas)
+            break
+        except RETRYABLE_ERRORS as e:
+            if attempt == MAX_RETRIES:
+                raise
+            delay = min(RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1), RETRY_BACKOFF_MAX_SECONDS)
+            logger.warning("HF attempt %d failed (%r), retrying in %ss", attempt, e, delay)
+            await asyncio.sleep(delay)
+
+    logger.debug("Model JSON output: %s", object_text)
+
+    challenge_data = orjson.loads(object_text)
+
+    _validate_challenge(challenge_data)
+
+    return challenge_data
+
+
+class LLMCache:
+    """In-process pool of generated challenges keyed by a hash of (model, difficulty)
+
+    Each pool holds up to ``pool_size`` variants that are served round-robin until
+    they expire; the pool is topped up in the background once it runs low.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = POOL_SIZE,
+        refill_threshold: int = POOL_REFILL_THRESHOLD,
+        ttl: float = POOL_TTL_SECONDS,
+        max_concurrent_fills: int = MAX_CONCURRENT_FILLS,
+    ):
+        self.pool_size = pool_size
+        self.refill_threshold = refill_threshold
+        self.ttl = ttl
+        self._fill_slots = asyncio.Semaphore(max_concurrent_fills)
+        self.hits = 0
+        self.misses = 0
+        self._pools: Dict[str, Deque[Tuple[float, Dict[str, Any]]]] = {}
+        self._refilling: Set[str] = set()
+        self._tasks: Set[asyncio.Task] = set()
+
+    @staticmethod
+    def cache_key(difficulty: str) -> str:
+        return hashlib.sha256(
+            orjson.dumps({"model": MODEL, "difficulty": difficulty}, option=orjson.OPT_SORT_KEYS)
+        ).hexdigest()
+
+    def _live_pool(self, difficulty: str) -> Deque[Tuple[float, Dict[str, Any]]]:
+        """Return the pool for a difficulty with expired variants dropped"""
+        pool = self._pools.setdefault(self.cache_key(difficulty), deque())
+        now = time.monotonic()
+        for _ in range(len(pool)):
+            expires_at, challenge = pool.popleft()
+            if expires_at > now:
+                pool.append((expires_at, challenge))
+        return pool
+
+    def get(self, difficulty: str) -> Optional[Dict[str, Any]]:
+        """Return the next pooled challenge, or None on a cache miss"""
+        if difficulty not in DIFFICULTIES:
+            self.misses += 1
+            return None
+
+        pool = self._live_pool(difficulty)
+        if not pool:
+            self.misses += 1
+            return None
+
+        entry = pool.popleft()
+        pool.append(entry)
+        self.hits += 1
+        return dict(entry[1])
+
+    def add(self, difficulty: str, challenge: Dict[str, Any]) -> None:
+        if difficulty not in DIFFICULTIES:
+            return
+
+        pool = self._live_pool(difficulty)
+        if len(pool) < self.pool_size:
+            pool.append((time.monotonic() + self.ttl, challenge))
+
+    async def fill(self, difficulty: str) -> None:
+        """Generate enough variants concurrently to bring the pool back to full size"""
+        missing = self.pool_size - len(self._live_pool(difficulty))
+        if missing <= 0:
+            return
+
+        results = await asyncio.gather(
+            *(self._generate_variant(difficulty) for _ in range(missing)),
+            return_exceptions=True,
         )
+        for result in results:
+            if isinstance(result, asyncio.CancelledError):
+                raise result
+            if isinstance(result, Exception):
+                logger.warning("Failed to generate %s variant: %s", difficulty, result)
+            else:
+                self.add(difficulty, result)
+
+    async def _generate_variant(self, difficulty: str) -> Dict[str, Any]:
+        async with self._fill_slots:
+            return await _request_challenge(difficulty)
+
+    def refill_if_needed(self, difficulty: str) -> None:
+        """Schedule a background refill when the pool drops below the threshold"""
+        if difficulty not in DIFFICULTIES or difficulty in self._refilling:
+            return
+        if len(self._live_pool(difficulty)) >= self.refill_threshold:
+            return
+
+        self._refilling.add(difficulty)
+        task = asyncio.create_task(self.fill(difficulty))
+        self._tasks.add(task)
+        task.add_done_callback(lambda t: self._refill_done(difficulty, t))
+
+    def _refill_done(self, difficulty: str, task: asyncio.Task) -> None:
+        self._refilling.discard(difficulty)
+        self._tasks.discard(task)
+
+    def prewarm(self) -> None:
+        """Start filling the pool for every known difficulty"""
+        for difficulty in DIFFICULTIES:
+            self.refill_if_needed(difficulty)
+
+    async def close(self) -> None:
+        """Cancel in-flight refills; call before closing the inference client"""
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
-        generated_text = response.choices[0].message["content"].strip()
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "pool_sizes": {d: len(self._live_pool(d)) for d in DIFFICULTIES},
+        }
 
-        # --- DEBUG LOGGING ---
-        print("---- RAW MODEL OUTPUT ----")
-        print(generated_text)
-        print("--------------------------")
 
-        # Extract only the first JSON object using regex
-        match = re.search(r'\{.*\}', generated_text, re.DOTALL)
-        if not match:
-            raise ValueError("No valid JSON found in model response")
+challenge_cache = LLMCache()
 
-        json_str = match.group(0)
-        challenge_data = json.loads(json_str)
 
-        # Validate required fields
-        required_fields = ["title", "options", "correct_answer_id", "explanation"]
-        for field in required_fields:
-            if field not in challenge_data:
-                raise ValueError(f"Missing required field: {field}")
+async def generate_challenge_with_ai(difficulty: str) -> Dict[str, Any]:
+    challenge_data = challenge_cache.get(difficulty)
+    if challenge_data is None:
+        try:
+            challenge_data = await _request_challenge(difficulty)
+        except Exception:
+            logger.exception("Challenge generation failed")
+            return get_fallback_challenge()
 
-        return challenge_data
+        challenge_cache.add(difficulty, challenge_data)
+        challenge_data = dict(challenge_data)
 
-    except Exception as e:
-        print(f"[ERROR] {e}")
-        return get_fallback_challenge()
+    challenge_cache.refill_if_needed(difficulty)
+    return challenge_data
 
 
 def get_fallback_challenge() -> Dict[str, Any]:
     """Return a fallback challenge if the API fails"""
-    print("[FALLBACK] Model failed — returning static challenge")
+    logger.warning("Model failed, returning static fallback challenge")
     return {
         "title": "Basic Python List Operation",
         "options": [
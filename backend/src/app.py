@@ -1,8 +1,26 @@
+from typing import Any
+import orjson
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse
 from .routes import challenge, webhooks
+from .ai_generator import challenge_cache, client as hf_client
+from .database.models import db_manager
+from .database.batcher import quota_batcher
+from .logging_config import start_logging, stop_logging
 
-app = FastAPI()
+
+class UTCORJSONResponse(ORJSONResponse):
+    """ORJSONResponse that writes naive datetimes as UTC, with an explicit offset"""
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(
+            content, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NAIVE_UTC
+        )
+
+
+app = FastAPI(default_response_class=UTCORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -12,6 +30,45 @@ app.add_middleware(
     allow_headers=["*"]
 )
 
+# History pages are text-heavy JSON; compress anything over 1 KB
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
+
+@app.on_event("startup")
+async def configure_logging():
+    start_logging()
+
+
+@app.on_event("startup")
+async def connect_db():
+    db_manager.connect()
+    await db_manager.ensure_indexes()
+    quota_batcher.start()
+
+
+@app.on_event("startup")
+async def prewarm_challenge_cache():
+    challenge_cache.prewarm()
+
+
+@app.on_event("shutdown")
+async def close_hf_client():
+    # Stop background pool refills first so they don't fail against a closed client
+    await challenge_cache.close()
+    # Release the pooled HTTP connections held by the shared inference client
+    await hf_client.aclose()
+
+
+@app.on_event("shutdown")
+async def close_db():
+    await quota_batcher.stop()
+    await db_manager.close()
+
+
+@app.on_event("shutdown")
+async def flush_logs():
+    stop_logging()
+
 
 app.include_router(challenge.router, prefix="/api")
 app.include_router(webhooks.router, prefix="/webhooks")
@@ -0,0 +1,134 @@
+# src/database/batcher.py
+
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from .db import quota_insert_fields
+from .models import DatabaseManager, db_manager
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY_ERROR = 11000
+
+# Queued by stop(); the flush loop writes out everything ahead of it, then exits
+_STOP = object()
+
+
+class QuotaUpsertBatcher:
+    """
+    Coalesces concurrent quota upserts into one bulk_write.
+    Callers await ensure_quota(); a background task collects everything queued
+    within flush_interval seconds and writes it in a single round trip.
+    """
+
+    def __init__(self, db_manager: DatabaseManager, flush_interval: float = 0.005, max_batch: int = 500):
+        self.db_manager = db_manager
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        """Start the flush loop; call from inside the running event loop"""
+        if self._task is not None:
+            return
+
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop the flush loop once it has written out everything already queued"""
+        if self._task is None:
+            return
+
+        # Clearing _task first makes ensure_quota refuse new work, so nothing
+        # can be queued behind the sentinel
+        task, self._task = self._task, None
+        self._queue.put_nowait(_STOP)
+        await task
+
+    async def ensure_quota(self, user_id: str) -> Optional[ObjectId]:
+        """
+        Create a user's challenge quota unless one already exists.
+        Returns the new quota's id, or None if the user already had a quota.
+        """
+        if self._task is None:
+            raise RuntimeError("QuotaUpsertBatcher is not running")
+
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((user_id, future))
+        return await future
+
+    async def _run(self) -> None:
+        while True:
+            batch: List[Tuple[str, asyncio.Future]] = []
+            try:
+                item = await self._queue.get()
+                if item is _STOP:
+                    return
+                batch.append(item)
+
+                # Give sibling requests a moment to join this batch
+                await asyncio.sleep(self.flush_interval)
+                stopping = False
+                while not self._queue.empty() and len(batch) < self.max_batch:
+                    item = self._queue.get_nowait()
+                    if item is _STOP:
+                        stopping = True
+                        break
+                    batch.append(item)
+
+                await self._flush(batch)
+                if stopping:
+                    return
+            except asyncio.CancelledError:
+                # Cancelled from outside (not via stop): don't leave dequeued callers hanging
+                for _, future in batch:
+                    future.cancel()
+                raise
+
+    async def _flush(self, batch: List[Tuple[str, asyncio.Future]]) -> None:
+        # The same user can be queued twice; upsert each user once
+        waiters: Dict[str, List[asyncio.Future]] = {}
+        for user_id, future in batch:
+            waiters.setdefault(user_id, []).append(future)
+        user_ids = list(waiters)
+
+        fields = quota_insert_fields(datetime.now(timezone.utc))
+        ops = [UpdateOne({"user_id": user_id}, {"$setOnInsert": fields}, upsert=True) for user_id in user_ids]
+
+        upserted: Dict[int, ObjectId] = {}
+        errors: Dict[int, Exception] = {}
+        try:
+            result = await self.db_manager.challenge_quotas.bulk_write(ops, ordered=False)
+            upserted = result.upserted_ids
+        except BulkWriteError as e:
+            upserted = {u["index"]: u["_id"] for u in e.details.get("upserted", [])}
+            for error in e.details.get("writeErrors", []):
+                # A duplicate key means a concurrent writer created the quota first
+                if error["code"] != DUPLICATE_KEY_ERROR:
+                    errors[error["index"]] = e
+        except Exception as e:
+            logger.exception("Quota upsert batch of %d failed", len(ops))
+            errors = dict.fromkeys(range(len(ops)), e)
+
+        for index, user_id in enumerate(user_ids):
+            first = waiters[user_id][0]
+            for future in waiters[user_id]:
+                if future.done():
+                    continue
+                if index in errors:
+                    future.set_exception(errors[index])
+                else:
+                    # Only the first waiter for a user sees the newly created id
+                    future.set_result(upserted.get(index) if future is first else None)
+
+
+# Shared batcher for webhook quota creation, started with the app
+quota_batcher = QuotaUpsertBatcher(db_manager)
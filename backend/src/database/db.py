@@ -1,9 +1,14 @@
 # src/database/db.py
 
-from pymongo import MongoClient
-from datetime import datetime, timedelta
+import logging
+from cachetools import TTLCache
+from pymongo import ReturnDocument, DESCENDING
+from pymongo.errors import DuplicateKeyError
+from pymongo.asynchronous.cursor import AsyncCursor
+from datetime import datetime, timedelta, timezone
 from bson import ObjectId
-from typing import Optional, List, Dict, Any, TYPE_CHECKING
+from bson.errors import InvalidId
+from typing import Optional, List, Dict, Any, Tuple, TYPE_CHECKING
 
 # This is the key change to prevent circular imports at runtime.
 # It allows type checkers (like in your IDE) to see the import,
@@ -11,61 +16,93 @@ from typing import Optional, List, Dict, Any, TYPE_CHECKING
 if TYPE_CHECKING:
     from .models import DatabaseManager
 
-def get_challenge_quota(db_manager: "DatabaseManager", user_id: str) -> Optional[Dict[str, Any]]:
-    """Get challenge quota for a user"""
-    try:
-        return db_manager.challenge_quotas.find_one({"user_id": user_id})
-    except Exception as e:
-        print(f"Error getting challenge quota: {e}")
-        return None
+logger = logging.getLogger(__name__)
 
-def create_challenge_quota(db_manager: "DatabaseManager", user_id: str) -> Dict[str, Any]:
-    """Create a new challenge quota for a user"""
-    try:
-        quota_doc = {
-            "user_id": user_id,
-            "quota_remaining": 50,  # Default quota
-            "last_reset_date": datetime.now(),
-            "created_at": datetime.now()
-        }
-        
-        result = db_manager.challenge_quotas.insert_one(quota_doc)
-        quota_doc["_id"] = result.inserted_id
-        return quota_doc
-    except Exception as e:
-        print(f"Error creating challenge quota: {e}")
-        raise
+# challenge_quotas documents hold:
+#   user_id          - Clerk user id (unique)
+#   quota_remaining  - challenges left until the next reset
+#   last_reset_date  - when quota_remaining was last refilled
+#   created_at       - when the quota was created
+DEFAULT_QUOTA = 50
+QUOTA_RESET_INTERVAL = timedelta(hours=24)
 
-def reset_quota_if_needed(db_manager: "DatabaseManager", quota: Dict[str, Any]) -> Dict[str, Any]:
-    """Reset quota if 24 hours have passed since last reset"""
-    try:
-        now = datetime.now()
-        last_reset = quota.get("last_reset_date", now)
-        
-        if now - last_reset > timedelta(hours=24):
-            updated_quota = db_manager.challenge_quotas.find_one_and_update(
-                {"_id": quota["_id"]},
-                {
-                    "$set": {
-                        "quota_remaining": 50,  # Reset to default
-                        "last_reset_date": now
-                    }
-                },
-                return_document=True  # Returns the updated document
-            )
-            return updated_quota if updated_quota else quota
-        
+# Compound (created_by, date_created DESC, _id DESC) index created in DatabaseManager.ensure_indexes.
+# History is sorted and paged on (date_created, _id); _id only breaks ties.
+HISTORY_INDEX = "created_by_1_date_created_-1__id_-1"
+HISTORY_SORT = [("date_created", DESCENDING), ("_id", DESCENDING)]
+
+# Fields the history view renders; created_by is already known to the caller
+HISTORY_PROJECTION = {
+    "title": 1,
+    "difficulty": 1,
+    "options": 1,
+    "correct_answer_id": 1,
+    "explanation": 1,
+    "date_created": 1
+}
+
+# Quota documents are read on every /quota poll; serve repeat reads for a couple of
+# seconds from memory. Cached documents are shared, so callers must not mutate them.
+_QUOTA_CACHE: TTLCache = TTLCache(maxsize=10_000, ttl=2)
+
+# Aggregation expression, evaluated server-side: true once the reset interval has
+# passed since the quota was last reset (or if it never was)
+_DUE_FOR_RESET = {
+    "$gt": [
+        {"$subtract": ["$$NOW", {"$ifNull": ["$last_reset_date", datetime(1970, 1, 1, tzinfo=timezone.utc)]}]},
+        int(QUOTA_RESET_INTERVAL.total_seconds() * 1000)
+    ]
+}
+
+# Pipeline stage that creates a missing quota or resets one that is due
+_CREATE_OR_RESET_QUOTA = {"$set": {
+    "quota_remaining": {
+        "$cond": [_DUE_FOR_RESET, DEFAULT_QUOTA, {"$ifNull": ["$quota_remaining", DEFAULT_QUOTA]}]
+    },
+    "last_reset_date": {"$cond": [_DUE_FOR_RESET, "$$NOW", "$last_reset_date"]},
+    "created_at": {"$ifNull": ["$created_at", "$$NOW"]}
+}}
+
+def invalidate_quota_cache(user_id: str) -> None:
+    """Drop a user's cached quota after writing to it"""
+    _QUOTA_CACHE.pop(user_id, None)
+
+def quota_insert_fields(now: datetime) -> Dict[str, Any]:
+    """Fields set on a freshly created quota document (besides user_id)"""
+    return {
+        "quota_remaining": DEFAULT_QUOTA,
+        "last_reset_date": now,
+        "created_at": now
+    }
+
+async def refresh_quota(db_manager: "DatabaseManager", user_id: str) -> Dict[str, Any]:
+    """
+    Get a user's quota, creating it or resetting it if the reset interval has
+    passed, in one atomic round trip. Served from the quota cache when fresh.
+    """
+    quota = _QUOTA_CACHE.get(user_id)
+    if quota is not None:
         return quota
-    except Exception as e:
-        print(f"Error resetting quota: {e}")
+
+    try:
+        quota = await db_manager.challenge_quotas.find_one_and_update(
+            {"user_id": user_id},
+            [_CREATE_OR_RESET_QUOTA],
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        _QUOTA_CACHE[user_id] = quota
         return quota
+    except Exception:
+        logger.exception("Error refreshing challenge quota for %s", user_id)
+        raise
 
-def create_challenge(
+async def create_challenge(
     db_manager: "DatabaseManager",
     difficulty: str,
     created_by: str,
     title: str,
-    options: str,
+    options: List[str],
     correct_answer_id: int,
     explanation: str
 ) -> Dict[str, Any]:
@@ -78,32 +115,114 @@ def create_challenge(
             "options": options,
             "correct_answer_id": correct_answer_id,
             "explanation": explanation,
-            "date_created": datetime.now()
+            "date_created": datetime.now(timezone.utc)
         }
         
-        result = db_manager.challenges.insert_one(challenge_doc)
+        result = await db_manager.challenges.insert_one(challenge_doc)
         challenge_doc["_id"] = result.inserted_id
         return challenge_doc
-    except Exception as e:
-        print(f"Error creating challenge: {e}")
+    except Exception:
+        logger.exception("Error creating challenge for %s", created_by)
         raise
 
-def get_user_challenges(db_manager: "DatabaseManager", user_id: str) -> List[Dict[str, Any]]:
-    """Get all challenges created by a user"""
+async def create_challenges_bulk(db_manager: "DatabaseManager", challenges: List[Dict[str, Any]]) -> List[ObjectId]:
+    """Insert several challenge documents in one unordered batch"""
     try:
-        return list(db_manager.challenges.find({"created_by": user_id}))
-    except Exception as e:
-        print(f"Error getting user challenges: {e}")
-        return []
+        now = datetime.now(timezone.utc)
+        for challenge_doc in challenges:
+            challenge_doc.setdefault("date_created", now)
+
+        result = await db_manager.challenges.insert_many(challenges, ordered=False)
+        return result.inserted_ids
+    except Exception:
+        logger.exception("Error creating %d challenges in bulk", len(challenges))
+        raise
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def encode_history_cursor(date_created: datetime, challenge_id: ObjectId) -> str:
+    """Page cursor for the last challenge on a history page: "<date_created ms>-<_id>"."""
+    return f"{(date_created - _EPOCH) // timedelta(milliseconds=1)}-{challenge_id}"
+
+def decode_history_cursor(cursor: str) -> Tuple[datetime, ObjectId]:
+    """Inverse of encode_history_cursor; raises ValueError for a malformed cursor"""
+    millis, _, challenge_id = cursor.rpartition("-")
+    try:
+        return _EPOCH + timedelta(milliseconds=int(millis)), ObjectId(challenge_id)
+    except (InvalidId, OverflowError) as e:
+        raise ValueError(f"Invalid history cursor: {cursor}") from e
+
+def find_user_challenges(
+    db_manager: "DatabaseManager",
+    user_id: str,
+    limit: int = 50,
+    before: Optional[Tuple[datetime, ObjectId]] = None
+) -> AsyncCursor:
+    """
+    Cursor over a page of challenges created by a user, newest first.
+    Pass the decoded cursor of the previous page as before to continue.
+    """
+    query: Dict[str, Any] = {"created_by": user_id}
+    if before is not None:
+        # Keyset on the sort key itself, so pages never skip or repeat rows
+        before_date, before_id = before
+        query["$or"] = [
+            {"date_created": {"$lt": before_date}},
+            {"date_created": before_date, "_id": {"$lt": before_id}}
+        ]
 
-def update_challenge_quota(db_manager: "DatabaseManager", quota_id: ObjectId, decrement: int = 1) -> bool:
-    """Update challenge quota by decrementing the remaining count"""
+    # Pin the history index so the sort is always read off it, and ask for the
+    # whole page in one batch so it arrives in a single round trip
+    return (
+        db_manager.challenges.find(query, HISTORY_PROJECTION)
+        .sort(HISTORY_SORT)
+        .hint(HISTORY_INDEX)
+        .limit(limit)
+        .batch_size(limit)
+    )
+
+async def count_user_challenges(db_manager: "DatabaseManager", user_id: str) -> int:
+    """Count challenges created by a user straight off the history index"""
+    return await db_manager.challenges.count_documents({"created_by": user_id}, hint=HISTORY_INDEX)
+
+async def refund_quota(db_manager: "DatabaseManager", user_id: str) -> None:
+    """Give back a challenge taken by consume_quota when the request then failed"""
     try:
-        result = db_manager.challenge_quotas.update_one(
-            {"_id": quota_id},
-            {"$inc": {"quota_remaining": -decrement}}
+        await db_manager.challenge_quotas.update_one(
+            {"user_id": user_id},
+            [{"$set": {"quota_remaining": {"$min": [{"$add": ["$quota_remaining", 1]}, DEFAULT_QUOTA]}}}]
         )
-        return result.modified_count > 0
-    except Exception as e:
-        print(f"Error updating challenge quota: {e}")
-        return False
\ No newline at end of file
+        invalidate_quota_cache(user_id)
+    except Exception:
+        logger.exception("Error refunding challenge quota for %s", user_id)
+
+async def consume_quota(db_manager: "DatabaseManager", user_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Take one challenge from a user's quota in a single round trip.
+    Creates the quota on first use and resets it once the reset interval has
+    passed, all server-side. Returns None if the quota is exhausted.
+    """
+    # Only quotas with a challenge left, or due for a reset, match
+    query = {"user_id": user_id, "$or": [{"quota_remaining": {"$gt": 0}}, {"$expr": _DUE_FOR_RESET}]}
+    update = [
+        _CREATE_OR_RESET_QUOTA,
+        {"$set": {"quota_remaining": {"$subtract": ["$quota_remaining", 1]}}}
+    ]
+    try:
+        try:
+            quota = await db_manager.challenge_quotas.find_one_and_update(
+                query, update, upsert=True, return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # The user's quota exists but didn't match, so the upsert collided with it
+            # on the unique user_id index. Usually it is exhausted; retrying without
+            # upsert also covers a concurrent first request having just created it.
+            quota = await db_manager.challenge_quotas.find_one_and_update(
+                query, update, return_document=ReturnDocument.AFTER
+            )
+        invalidate_quota_cache(user_id)
+
+        return quota
+    except Exception:
+        logger.exception("Error consuming challenge quota for %s", user_id)
+        raise
@@ -1,20 +1,26 @@
-from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from typing import Dict, Any
+from typing import Dict, Any, AsyncIterator, Optional
+import orjson
 
-from ..ai_generator import generate_challenge_with_ai
+from ..ai_generator import generate_challenge_with_ai, challenge_cache
 from ..database.db import (
-    get_challenge_quota,
     create_challenge,
-    create_challenge_quota,
-    reset_quota_if_needed,
-    get_user_challenges
+    refresh_quota,
+    find_user_challenges,
+    encode_history_cursor,
+    decode_history_cursor,
+    count_user_challenges,
+    consume_quota,
+    refund_quota,
+    invalidate_quota_cache
 )
-from ..utils import authenticate_and_get_user_details
+from ..utils import current_user
 from ..database.models import get_db, DatabaseManager
-import json
-from datetime import datetime
+from datetime import datetime, timezone
 from bson import ObjectId
+from pymongo.asynchronous.cursor import AsyncCursor
 
 router = APIRouter()
 
@@ -24,82 +30,79 @@ class ChallengeRequest(BaseModel):
     class Config:
         json_schema_extra = {"example": {"difficulty": "easy"}}
 
+_HEX_DIGITS = frozenset("0123456789abcdefABCDEF")
+
+def _is_object_id(value: str) -> bool:
+    """Cheap check that a string is a 24-character hex ObjectId, without raising"""
+    return len(value) == 24 and _HEX_DIGITS.issuperset(value)
+
+def _orjson_default(value: Any) -> Any:
+    """Encode the BSON types orjson has no native support for"""
+    if isinstance(value, ObjectId):
+        return str(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
 def serialize_mongo_doc(doc: Dict[str, Any]) -> Dict[str, Any]:
-    """Convert MongoDB document to JSON serializable format"""
+    """
+    Expose a MongoDB document's _id as a string id (in place).
+    Datetimes are left for the JSON encoder, which handles them natively.
+    """
     if doc is None:
         return None
     
-    # Convert ObjectId to string
-    if "_id" in doc:
-        doc["id"] = str(doc["_id"])
-        del doc["_id"]
-    
-    # Convert datetime objects to ISO format strings
-    for key, value in doc.items():
-        if isinstance(value, datetime):
-            doc[key] = value.isoformat()
-        elif isinstance(value, ObjectId):
-            doc[key] = str(value)
+    oid = doc.pop("_id", None)
+    if oid is not None:
+        doc["id"] = str(oid)
     
     return doc
 
 def serialize_mongo_docs(docs: list) -> list:
     """Convert list of MongoDB documents to JSON serializable format"""
-    return [serialize_mongo_doc(doc.copy()) for doc in docs if doc is not None]
+    return [serialize_mongo_doc(doc) for doc in docs if doc is not None]
 
 @router.post("/generate-challenge")
 async def generate_challenge(
     request: ChallengeRequest, 
-    request_obj: Request, 
+    user: dict = Depends(current_user),
     db: DatabaseManager = Depends(get_db)
 ):
     try:
-        user_details = authenticate_and_get_user_details(request_obj)
-        user_id = user_details.get("user_id")
-
-        # Get or create quota
-        quota = get_challenge_quota(db, user_id)
-        if not quota:
-            quota = create_challenge_quota(db, user_id)
-
-        # Reset quota if needed
-        quota = reset_quota_if_needed(db, quota)
+        user_id = user.get("user_id")
 
-        # Check quota
-        if quota.get("quota_remaining", 0) <= 0:
+        # Create, reset and decrement the quota in one atomic update
+        quota = await consume_quota(db, user_id)
+        if quota is None:
             raise HTTPException(status_code=429, detail="Quota exhausted")
 
         # Generate challenge with AI
-        challenge_data = generate_challenge_with_ai(request.difficulty)
-
-        # Create challenge document
-        new_challenge = create_challenge(
-            db_manager=db,
-            difficulty=request.difficulty,
-            created_by=user_id,
-            title=challenge_data["title"],
-            options=json.dumps(challenge_data["options"]),
-            correct_answer_id=challenge_data["correct_answer_id"],
-            explanation=challenge_data["explanation"]
-        )
+        challenge_data = await generate_challenge_with_ai(request.difficulty)
 
-        # Update quota (decrement by 1)
-        db.challenge_quotas.update_one(
-            {"_id": quota["_id"]},
-            {"$inc": {"quota_remaining": -1}}
-        )
+        # Create challenge document, handing the quota back if that fails
+        try:
+            new_challenge = await create_challenge(
+                db_manager=db,
+                difficulty=request.difficulty,
+                created_by=user_id,
+                title=challenge_data["title"],
+                options=challenge_data["options"],
+                correct_answer_id=challenge_data["correct_answer_id"],
+                explanation=challenge_data["explanation"]
+            )
+        except Exception:
+            await refund_quota(db, user_id)
+            raise
 
         # Serialize response
-        response_challenge = serialize_mongo_doc(new_challenge.copy())
+        response_challenge = serialize_mongo_doc(new_challenge)
         
         return {
             "id": response_challenge["id"],
             "difficulty": request.difficulty,
             "title": response_challenge["title"],
-            "options": json.loads(response_challenge["options"]),
+            "options": response_challenge["options"],
             "correct_answer_id": response_challenge["correct_answer_id"],
             "explanation": response_challenge["explanation"],
-            "timestamp": response_challenge.get("date_created", datetime.now().isoformat())
+            "timestamp": response_challenge.get("date_created", datetime.now(timezone.utc).isoformat())
         }
 
     except HTTPException:
@@ -107,63 +110,84 @@ async def generate_challenge(
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+async def _stream_history(
+    cursor: AsyncCursor,
+    first: Optional[Dict[str, Any]],
+    limit: int
+) -> AsyncIterator[bytes]:
+    """
+    Write the history page as JSON one challenge at a time, straight off the cursor.
+    first is the page's first challenge, already fetched by the caller (None if empty).
+    """
+    count = 0
+    last_key = None
+    challenge = first
+    try:
+        yield b'{"challenges":['
+        while challenge is not None:
+            if count:
+                yield b","
+            last_key = (challenge["date_created"], challenge["_id"])
+            challenge = serialize_mongo_doc(challenge)
+            count += 1
+            yield orjson.dumps(challenge, default=_orjson_default, option=orjson.OPT_NAIVE_UTC)
+            challenge = await anext(cursor, None)
+
+        next_cursor = encode_history_cursor(*last_key) if count == limit else None
+        yield b'],"next_cursor":' + orjson.dumps(next_cursor) + b"}"
+    finally:
+        await cursor.close()
+
 @router.get("/my-history")
 async def my_history(
-    request: Request, 
+    limit: int = Query(50, ge=1, le=100),
+    before: Optional[str] = None,
+    user: dict = Depends(current_user),
     db: DatabaseManager = Depends(get_db)
 ):
     try:
-        user_details = authenticate_and_get_user_details(request)
-        user_id = user_details.get("user_id")
+        user_id = user.get("user_id")
 
-        # Get user challenges
-        challenges = get_user_challenges(db, user_id)
-        
-        # Serialize challenges for JSON response
-        serialized_challenges = []
-        for challenge in challenges:
-            challenge_copy = challenge.copy()
-            serialized_challenge = serialize_mongo_doc(challenge_copy)
-            
-            # Parse options if it's a JSON string
-            if "options" in serialized_challenge and isinstance(serialized_challenge["options"], str):
-                try:
-                    serialized_challenge["options"] = json.loads(serialized_challenge["options"])
-                except json.JSONDecodeError:
-                    pass  # Keep as string if not valid JSON
-            
-            serialized_challenges.append(serialized_challenge)
-        
-        return {"challenges": serialized_challenges}
+        try:
+            before_key = decode_history_cursor(before) if before is not None else None
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid history cursor")
+
+        # Run the query before the 200 goes out so a failure becomes an error response
+        # rather than truncated JSON. The whole page arrives in that first batch, so
+        # the rest streams from memory without another round trip.
+        cursor = find_user_challenges(db, user_id, limit=limit, before=before_key)
+        try:
+            first = await anext(cursor, None)
+        except Exception:
+            await cursor.close()
+            raise
+
+        return StreamingResponse(_stream_history(cursor, first, limit), media_type="application/json")
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @router.get("/quota")
 async def get_quota(
-    request: Request, 
+    user: dict = Depends(current_user),
     db: DatabaseManager = Depends(get_db)
 ):
     try:
-        user_details = authenticate_and_get_user_details(request)
-        user_id = user_details.get("user_id")
-
-        # Get or create quota
-        quota = get_challenge_quota(db, user_id)
-        if not quota:
-            quota = create_challenge_quota(db, user_id)
+        user_id = user.get("user_id")
 
-        # Reset quota if needed
-        quota = reset_quota_if_needed(db, quota)
-        
-        # Serialize quota for JSON response
-        serialized_quota = serialize_mongo_doc(quota.copy())
+        # Get, create or reset the quota in one atomic update
+        quota = await refresh_quota(db, user_id)
         
+        # Read fields straight off the quota - it may be the shared cached document,
+        # so it must not be serialized in place
         return {
-            "id": serialized_quota.get("id"),
-            "user_id": serialized_quota.get("user_id"),
-            "quota_remaining": serialized_quota.get("quota_remaining", 0),
-            "last_reset_date": serialized_quota.get("last_reset_date")
+            "id": str(quota["_id"]),
+            "user_id": quota.get("user_id"),
+            "quota_remaining": quota.get("quota_remaining", 0),
+            "last_reset_date": quota.get("last_reset_date")
         }
 
     except Exception as e:
@@ -173,25 +197,25 @@ async def get_quota(
 
 @router.get("/quota/reset")
 async def force_reset_quota(
-    request: Request, 
+    user: dict = Depends(current_user),
     db: DatabaseManager = Depends(get_db)
 ):
     """Force reset quota (useful for testing or admin purposes)"""
     try:
-        user_details = authenticate_and_get_user_details(request)
-        user_id = user_details.get("user_id")
+        user_id = user.get("user_id")
 
         # Update quota directly
-        result = db.challenge_quotas.update_one(
+        result = await db.challenge_quotas.update_one(
             {"user_id": user_id},
             {
                 "$set": {
                     "quota_remaining": 50,  # Reset to default
-                    "last_reset_date": datetime.now()
+                    "last_reset_date": datetime.now(timezone.utc)
                 }
             },
             upsert=True
         )
+        invalidate_quota_cache(user_id)
         
         if result.modified_count > 0 or result.upserted_id:
             return {"message": "Quota reset successfully", "quota_remaining": 50}
@@ -205,16 +229,15 @@ async def force_reset_quota(
 
 @router.get("/challenges/count")
 async def get_challenge_count(
-    request: Request, 
+    user: dict = Depends(current_user),
     db: DatabaseManager = Depends(get_db)
 ):
     """Get total number of challenges created by user"""
     try:
-        user_details = authenticate_and_get_user_details(request)
-        user_id = user_details.get("user_id")
+        user_id = user.get("user_id")
 
         # Count challenges
-        count = db.challenges.count_documents({"created_by": user_id})
+        count = await count_user_challenges(db, user_id)
         
         return {"total_challenges": count}
 
@@ -224,22 +247,20 @@ async def get_challenge_count(
 @router.delete("/challenges/{challenge_id}")
 async def delete_challenge(
     challenge_id: str,
-    request: Request, 
+    user: dict = Depends(current_user),
     db: DatabaseManager = Depends(get_db)
 ):
     """Delete a specific challenge (only by the creator)"""
     try:
-        user_details = authenticate_and_get_user_details(request)
-        user_id = user_details.get("user_id")
+        user_id = user.get("user_id")
 
         # Validate ObjectId format
-        try:
-            obj_id = ObjectId(challenge_id)
-        except:
+        if not _is_object_id(challenge_id):
             raise HTTPException(status_code=400, detail="Invalid challenge ID format")
+        obj_id = ObjectId(challenge_id)
 
         # Delete challenge (only if created by current user)
-        result = db.challenges.delete_one({
+        result = await db.challenges.delete_one({
             "_id": obj_id,
             "created_by": user_id
         })
@@ -255,4 +276,9 @@ async def delete_challenge(
     except HTTPException:
         raise
     except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/cache-stats")
+async def get_cache_stats():
+    """Hit/miss counters and pool sizes for the AI challenge cache"""
+    return challenge_cache.stats()
@@ -1,48 +1,52 @@
 from fastapi import APIRouter, Request, HTTPException, Depends
-from ..database.db import create_challenge_quota
+from ..database.db import invalidate_quota_cache
+from ..database.batcher import quota_batcher
 from ..database.models import get_db, DatabaseManager
 from svix.webhooks import Webhook
+import logging
 import os
-import json
+import asyncio
+import orjson
+
+logger = logging.getLogger(__name__)
+
+# The secret only changes with the process environment (loaded by database.models),
+# so decode it into a verifier once
+_CLERK_SECRET = os.environ.get("CLERK_WEBHOOK_SECRET")
+_WH = Webhook(_CLERK_SECRET) if _CLERK_SECRET else None
 
 router = APIRouter()
 
-@router.post("/clerk")
-async def handle_user_created(request: Request, db: DatabaseManager = Depends(get_db)):
-    webhook_secret = os.getenv("CLERK_WEBHOOK_SECRET")
-    
-    if not webhook_secret:
+async def verified_event(request: Request) -> dict:
+    """Dependency that checks the Svix signature of a Clerk webhook and returns its parsed payload"""
+    if _WH is None:
         raise HTTPException(status_code=500, detail="CLERK_WEBHOOK_SECRET not set")
     
     body = await request.body()
-    payload = body.decode("utf-8")
-    headers = dict(request.headers)
     
     try:
-        # Verify webhook signature
-        wh = Webhook(webhook_secret)
-        wh.verify(payload, headers)
-        
-        # Parse webhook data
-        data = json.loads(payload)
-        event_type = data.get("type")
-        print(f"[WEBHOOK] Received event: {event_type}")
-        
-        # Handle different event types
-        if event_type == "user.created":
-            return await handle_user_created_event(data, db)
-        elif event_type == "user.deleted":
-            return await handle_user_deleted_event(data, db)
-        elif event_type == "user.updated":
-            return await handle_user_updated_event(data, db)
-        else:
-            print(f"[WEBHOOK] Ignoring event type: {event_type}")
-            return {"status": "ignored", "event_type": event_type}
-    
+        await asyncio.to_thread(_WH.verify, body, request.headers)
+        return orjson.loads(body)
     except Exception as e:
-        print(f"[WEBHOOK ERROR] {str(e)}")
+        logger.error("Webhook rejected: %s", e)
         raise HTTPException(status_code=401, detail=str(e))
 
+@router.post("/clerk")
+async def handle_user_created(data: dict = Depends(verified_event), db: DatabaseManager = Depends(get_db)):
+    event_type = data.get("type")
+    logger.info("Received event: %s", event_type)
+    
+    # Handle different event types
+    if event_type == "user.created":
+        return await handle_user_created_event(data, db)
+    elif event_type == "user.deleted":
+        return await handle_user_deleted_event(data, db)
+    elif event_type == "user.updated":
+        return await handle_user_updated_event(data, db)
+    else:
+        logger.info("Ignoring event type: %s", event_type)
+        return {"status": "ignored", "event_type": event_type}
+
 async def handle_user_created_event(data: dict, db: DatabaseManager) -> dict:
     """Handle user.created event from Clerk"""
     try:
@@ -50,38 +54,36 @@ async def handle_user_created_event(data: dict, db: DatabaseManager) -> dict:
         user_id = user_data.get("id")
         
         if not user_id:
-            print("[WEBHOOK ERROR] No user ID found in webhook data")
+            logger.error("No user ID found in webhook data")
             raise HTTPException(status_code=400, detail="No user ID found in webhook data")
         
-        print(f"[WEBHOOK] Creating quota for user: {user_id}")
+        logger.info("Creating quota for user: %s", user_id)
         
-        # Check if quota already exists (prevent duplicates)
-        existing_quota = db.challenge_quotas.find_one({"user_id": user_id})
-        if existing_quota:
-            print(f"[WEBHOOK] Quota already exists for user: {user_id}")
+        # Create challenge quota for new user; concurrent signups share one bulk upsert
+        # and the unique user_id index prevents duplicates
+        quota_id = await quota_batcher.ensure_quota(user_id)
+        if quota_id is None:
+            logger.info("Quota already exists for user: %s", user_id)
             return {
                 "status": "success", 
                 "message": "User quota already exists",
                 "user_id": user_id
             }
         
-        # Create challenge quota for new user
-        quota = create_challenge_quota(db, user_id)
-        
         # Log additional user info for debugging
         email = user_data.get("email_addresses", [{}])[0].get("email_address")
         username = user_data.get("username")
-        print(f"[WEBHOOK] Created quota for user: {user_id}, email: {email}, username: {username}")
+        logger.info("Created quota for user: %s, email: %s, username: %s", user_id, email, username)
         
         return {
             "status": "success", 
             "message": "User quota created successfully",
             "user_id": user_id,
-            "quota_id": str(quota["_id"]) if "_id" in quota else None
+            "quota_id": str(quota_id)
         }
         
     except Exception as e:
-        print(f"[WEBHOOK ERROR] Failed to create user quota: {str(e)}")
+        logger.error("Failed to create user quota: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to create user quota: {str(e)}")
 
 async def handle_user_deleted_event(data: dict, db: DatabaseManager) -> dict:
@@ -91,18 +93,23 @@ async def handle_user_deleted_event(data: dict, db: DatabaseManager) -> dict:
         user_id = user_data.get("id")
         
         if not user_id:
-            print("[WEBHOOK ERROR] No user ID found in webhook data")
+            logger.error("No user ID found in webhook data")
             return {"status": "error", "message": "No user ID found"}
         
-        print(f"[WEBHOOK] Deleting data for user: {user_id}")
-        
-        # Delete user's challenge quota
-        quota_result = db.challenge_quotas.delete_one({"user_id": user_id})
+        logger.info("Deleting data for user: %s", user_id)
         
-        # Delete user's challenges (optional - you might want to keep them for analytics)
-        challenges_result = db.challenges.delete_many({"created_by": user_id})
+        # Delete user's challenge quota and challenges concurrently
+        # (dropping challenges is optional - you might want to keep them for analytics)
+        quota_result, challenges_result = await asyncio.gather(
+            db.challenge_quotas.delete_one({"user_id": user_id}),
+            db.challenges.delete_many({"created_by": user_id})
+        )
+        invalidate_quota_cache(user_id)
         
-        print(f"[WEBHOOK] Deleted {quota_result.deleted_count} quota(s) and {challenges_result.deleted_count} challenge(s) for user: {user_id}")
+        logger.info(
+            "Deleted %d quota(s) and %d challenge(s) for user: %s",
+            quota_result.deleted_count, challenges_result.deleted_count, user_id
+        )
         
         return {
             "status": "success",
@@ -113,7 +120,7 @@ async def handle_user_deleted_event(data: dict, db: DatabaseManager) -> dict:
         }
         
     except Exception as e:
-        print(f"[WEBHOOK ERROR] Failed to delete user data: {str(e)}")
+        logger.error("Failed to delete user data: %s", e)
         # Don't raise exception here - user deletion should still succeed even if cleanup fails
         return {
             "status": "partial_success",
@@ -127,7 +134,7 @@ async def handle_user_updated_event(data: dict, db: DatabaseManager) -> dict:
         user_data = data.get("data", {})
         user_id = user_data.get("id")
         
-        print(f"[WEBHOOK] User updated: {user_id}")
+        logger.info("User updated: %s", user_id)
         
         # You might want to update user-related data here
         # For now, just log the event
@@ -139,7 +146,7 @@ async def handle_user_updated_event(data: dict, db: DatabaseManager) -> dict:
         }
         
     except Exception as e:
-        print(f"[WEBHOOK ERROR] Failed to handle user update: {str(e)}")
+        logger.error("Failed to handle user update: %s", e)
         return {
             "status": "error",
             "message": f"Failed to handle user update: {str(e)}"
@@ -147,39 +154,21 @@ async def handle_user_updated_event(data: dict, db: DatabaseManager) -> dict:
 
 # Additional webhook endpoints for other Clerk events (optional)
 @router.post("/clerk/session")
-async def handle_session_events(request: Request, db: DatabaseManager = Depends(get_db)):
+async def handle_session_events(data: dict = Depends(verified_event), db: DatabaseManager = Depends(get_db)):
     """Handle session-related events from Clerk"""
-    webhook_secret = os.getenv("CLERK_WEBHOOK_SECRET")
+    event_type = data.get("type")
     
-    if not webhook_secret:
-        raise HTTPException(status_code=500, detail="CLERK_WEBHOOK_SECRET not set")
+    logger.info("Received session event: %s", event_type)
     
-    body = await request.body()
-    payload = body.decode("utf-8")
-    headers = dict(request.headers)
+    # Handle session events (session.created, session.ended, etc.)
+    if event_type in ["session.created", "session.ended", "session.removed"]:
+        # Log session activity or update user activity tracking
+        user_id = data.get("data", {}).get("user_id")
+        if user_id:
+            logger.info("%s for user: %s", event_type, user_id)
+            # You could track user activity, last login, etc. here
     
-    try:
-        wh = Webhook(webhook_secret)
-        wh.verify(payload, headers)
-        
-        data = json.loads(payload)
-        event_type = data.get("type")
-        
-        print(f"[SESSION WEBHOOK] Received event: {event_type}")
-        
-        # Handle session events (session.created, session.ended, etc.)
-        if event_type in ["session.created", "session.ended", "session.removed"]:
-            # Log session activity or update user activity tracking
-            user_id = data.get("data", {}).get("user_id")
-            if user_id:
-                print(f"[SESSION WEBHOOK] {event_type} for user: {user_id}")
-                # You could track user activity, last login, etc. here
-        
-        return {"status": "success", "event_type": event_type}
-        
-    except Exception as e:
-        print(f"[SESSION WEBHOOK ERROR] {str(e)}")
-        raise HTTPException(status_code=401, detail=str(e))
+    return {"status": "success", "event_type": event_type}
 
 # Health check endpoint for webhook testing
 @router.get("/clerk/health")
@@ -188,5 +177,5 @@ async def webhook_health_check():
     return {
         "status": "healthy",
         "service": "clerk_webhooks",
-        "webhook_secret_configured": bool(os.getenv("CLERK_WEBHOOK_SECRET"))
+        "webhook_secret_configured": bool(_CLERK_SECRET)
     }
\ No newline at end of file
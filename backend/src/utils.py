@@ -1,5 +1,6 @@
-from fastapi import HTTPException
+from fastapi import HTTPException, Request
 from clerk_backend_api import Clerk, AuthenticateRequestOptions
+import asyncio
 import os
 from dotenv import load_dotenv
 
@@ -25,4 +26,11 @@ def authenticate_and_get_user_details(request):
 
         return {"user_id": user_id}
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
+
+async def current_user(request: Request) -> dict:
+    """
+    FastAPI dependency for the signed-in user. Verification runs in a worker
+    thread, and the result is cached for the rest of the request.
+    """
+    return await asyncio.to_thread(authenticate_and_get_user_details, request)